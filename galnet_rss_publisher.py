@@ -1,19 +1,27 @@
 import sys
+import collections
 import os
 import json
 import logging
 import re
+import html
+import hashlib
 import time
-from typing import Any
+import functools
+from io import BytesIO
+from types import SimpleNamespace
+from typing import Any, Iterator
 
 from botocore.exceptions import ClientError
 import boto3
 import boto3.session
 
-import atoma, atoma.rss
-import bleach
+import orjson
+from lxml import etree
 import requests
 from requests import ConnectionError, HTTPError, Timeout
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Environment Variables
 #
@@ -25,12 +33,23 @@ from requests import ConnectionError, HTTPError, Timeout
 # LOGGING_LEVEL=<log level> -- Level for logging messages
 
 GALNET_BASE_URL = 'https://community.elitedangerous.com/en/galnet/uid'
-MAX_MSG_LEN = 2000
+MAX_EMBEDS_PER_MSG = 10
+MAX_EMBED_TITLE_LEN = 256
+MAX_EMBED_DESC_LEN = 4096
+MAX_EMBED_TOTAL_LEN = 6000
 MAX_ARTICLES_SEEN = 30
 LOCAL_STATE_FILENAME = 'rss_state.json'
 REQUEST_TIMEOUT = 5
+USER_AGENT = 'galnet-rss-publisher/1.0 (+lambda)'
+DEFAULT_RATE_LIMIT_DELAY = 1.0
+MAX_RATE_LIMIT_DELAY = 5.0
+MAX_RATE_LIMIT_RETRIES = 2
+WEBHOOK_URL_CACHE_TTL = 3600
 EMDASH = '\u2014'
 
+# Returned by fetch_rss_feed when the server reports the feed is unchanged
+FEED_NOT_MODIFIED = object()
+
 # Set up root log level
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -43,18 +62,24 @@ local_state = os.environ.get('LOCAL_STATE', 'False').lower() == 'true'
 # Get what region we're running in
 region = os.environ.get('AWS_REGION')
 
-# Create boto session and clients
-aws = boto3.session.Session(region_name=region)
-secretsmanager = aws.client('secretsmanager')
-if not local_state:
-    s3 = aws.client('s3')
+# Create pooled HTTP session, reused across warm invocations
+session = requests.Session()
+http_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                           max_retries=Retry(total=3, backoff_factor=0.3,
+                                             status_forcelist=[429, 500, 502, 503, 504]))
+session.mount('http://', http_adapter)
+session.mount('https://', http_adapter)
 
-br_pat = re.compile('<br ?/>')
+guid_pat = re.compile('[A-Za-z0-9_-]+')
+tag_pat = re.compile('<[^>]+>')
 
 s3_bucket = os.environ.get('S3_BUCKET_NAME')
 s3_key = os.environ.get('S3_KEY_NAME')
 rss_url = os.environ.get('RSS_URL', '')
 
+# Webhook URL fetched from Secrets Manager and when, kept across warm invocations
+webhook_url_cache: tuple[str, float]|None = None
+
 log_levels = {
     'debug':    logging.DEBUG,
     'info':     logging.INFO,
@@ -72,50 +97,97 @@ def set_logger_level(level: str|None):
             logger.warning(f"Invalid logging level specified, ignorning. '{level}'")
 
 def paginate_message(content: str) -> list[str]:
+    # Slice parts out of the original string by offset rather than re-slicing the remainder
     parts = []
-    while(len(content) > 0):
-        if len(content) <= MAX_MSG_LEN:
-            parts.append(content)
+    pos = 0
+    content_len = len(content)
+    while pos < content_len:
+        end = pos + MAX_EMBED_DESC_LEN
+        if end >= content_len:
+            parts.append(content[pos:])
             break
 
-        idx = content.rfind("\n\n", 0, MAX_MSG_LEN - 3)
+        idx = content.rfind("\n\n", pos + 1, end)
         if idx < 0:
             logger.warning("Paragraph break was not found! Trying to break at a word.")
-            idx = content.rfind(" ", 0, MAX_MSG_LEN - 3)
+            idx = content.rfind(" ", pos + 1, end)
             if idx < 0:
                 logger.warning("Word break not found, breaking arbitrarily.")
-                idx = MAX_MSG_LEN - 3
-
-        parts.append(content[:idx] + "```")
-        if len(content) > idx:
-            if content[idx] == "\n":
-                idx += 2
-            elif content[idx] == " ":
-                idx += 1
-            content = "```\n" + content[idx:]
-        else:
-            content = ''
+                idx = end
+
+        parts.append(content[pos:idx])
+        if content[idx] == "\n":
+            idx += 2
+        elif content[idx] == " ":
+            idx += 1
+        pos = idx
 
     return parts
 
+def build_embeds(guid: str, title: str, desc: str) -> list[dict[str, str]]:
+    # First embed carries the title and link, any overflow follows as continuations
+    embeds = [{ 'description': part } for part in paginate_message(desc)] or [{}]
+    embeds[0].update({ 'title': title[:MAX_EMBED_TITLE_LEN], 'url': f"{GALNET_BASE_URL}/{guid}" })
+    return embeds
+
+def batch_embeds(articles_to_publish: list[tuple[str, list[dict[str, str]]]]) -> Iterator[tuple[list[dict[str, str]], list[str]]]:
+    # Pack consecutive embeds into as few messages as the webhook limits allow,
+    # yielding each batch with the guids of the articles it completes
+    batch: list[dict[str, str]] = []
+    batch_len = 0
+    completed: list[str] = []
+    for (guid, embeds) in articles_to_publish:
+        for embed in embeds:
+            embed_len = len(embed.get('title', '')) + len(embed.get('description', ''))
+            if batch and (len(batch) == MAX_EMBEDS_PER_MSG or batch_len + embed_len > MAX_EMBED_TOTAL_LEN):
+                yield batch, completed
+                batch, batch_len, completed = [], 0, []
+            batch.append(embed)
+            batch_len += embed_len
+        completed.append(guid)
+    if batch:
+        yield batch, completed
+
+# Strip any markup and decode entities, Discord displays text as-is
+def clean_text(text: str) -> str:
+    if '<' in text:
+        text = tag_pat.sub('', text)
+    return html.unescape(text)
+
 # Check items for things we wish to filter out
 def filter_item(title: str, body: str) -> bool:
     if title == "Week in Review":
         return True
     return False
 
+# Boto session and clients are created on first use, so cold starts only
+# pay for the clients the configuration actually needs
+@functools.cache
+def get_aws_session() -> boto3.session.Session:
+    return boto3.session.Session(region_name=region)
+
+@functools.cache
+def get_aws_client(service_name: str) -> Any:
+    return get_aws_session().client(service_name)
+
 def get_webhook_url() -> str:
+    global webhook_url_cache
+
     webhook_url = os.environ['WEBHOOK_URL']
     if not webhook_url.startswith('arn') and not webhook_url.startswith('http'):
         logger.error(f"Invalid webhook URL provided, '{webhook_url}'")
         raise ValueError("WEBHOOK_URL must be an arn or http/s URL")
 
     if webhook_url.startswith('arn:'):
-        logger.debug(f"Found ARN for URL, {webhook_url}")
+        logger.debug("Found ARN for URL, %s", webhook_url)
         service_name = webhook_url.split(':', maxsplit=5)[2]
         if service_name == 'secretsmanager':
+            if webhook_url_cache and time.monotonic() - webhook_url_cache[1] < WEBHOOK_URL_CACHE_TTL:
+                logger.debug("Using cached webhook URL")
+                return webhook_url_cache[0]
             logger.info("Fetching webhook URL from Secrets Manager")
-            res = secretsmanager.get_secret_value(SecretId=webhook_url)
+            res = get_aws_client('secretsmanager').get_secret_value(SecretId=webhook_url)
+            webhook_url_cache = (res['SecretString'], time.monotonic())
             return res['SecretString']
         else:
             logger.error("Unknown ARN service specified")
@@ -127,67 +199,122 @@ def get_webhook_url() -> str:
 
     raise RuntimeError("This error shouldn't be reached")
 
-def load_state() -> dict[str, Any]:
-    if not local_state:
-        try:
-            res = s3.get_object(Bucket=s3_bucket, Key=s3_key)
-            state_str = res['Body'].read().decode('utf-8')
-        except ClientError as ex:
-            if ex.response['Error']['Code'] != 'NoSuchKey':
-                logger.exception("S3 error occurred")
-                raise
-            logger.info("No previous state found, starting fresh")
-            state_str = '{}'
-    else:
-        try:
-            with open(LOCAL_STATE_FILENAME, 'r') as f:
-                state_str = f.read()
-        except FileNotFoundError:
-            logger.info("No previous state found, starting fresh")
-            state_str = '{}'
+def read_s3_state() -> bytes:
+    try:
+        res = get_aws_client('s3').get_object(Bucket=s3_bucket, Key=s3_key)
+        return res['Body'].read()
+    except ClientError as ex:
+        if ex.response['Error']['Code'] != 'NoSuchKey':
+            logger.exception("S3 error occurred")
+            raise
+        logger.info("No previous state found, starting fresh")
+        return b'{}'
+
+def write_s3_state(state_bytes: bytes):
+    get_aws_client('s3').put_object(Bucket=s3_bucket, Key=s3_key, Body=state_bytes)
+
+def read_local_state() -> bytes:
+    try:
+        with open(LOCAL_STATE_FILENAME, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        logger.info("No previous state found, starting fresh")
+        return b'{}'
+
+def write_local_state(state_bytes: bytes):
+    with open(LOCAL_STATE_FILENAME, 'wb') as f:
+        f.write(state_bytes)
+
+# Pick the state storage once rather than on every load / save
+if local_state:
+    read_state, write_state = read_local_state, write_local_state
+else:
+    read_state, write_state = read_s3_state, write_s3_state
 
+def load_state() -> dict[str, Any]:
+    state_bytes = read_state()
     try:
-        state = json.loads(state_str)
-    except json.JSONDecodeError:
+        state = orjson.loads(state_bytes)
+    except orjson.JSONDecodeError:
         logger.exception("Failed to decode state, starting fresh")
         state = {}
     logger.info("Last saved state loaded")
-    logger.debug(f"Last Saved State - {state}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Last Saved State - {state}")
     return state
 
+def state_digest(state: dict[str, Any]) -> bytes:
+    return hashlib.blake2b(orjson.dumps(state, option=orjson.OPT_SORT_KEYS), digest_size=16).digest()
+
 def save_state(state: dict[str, Any]):
-    state_str = json.dumps(state, indent=4)
-    logger.debug(f"Updated save state: {state_str}")
-    if not local_state:
-        res = s3.put_object(Bucket=s3_bucket, Key=s3_key, Body=state_str.encode('utf-8'))
-    else:
-        with open(LOCAL_STATE_FILENAME, 'w') as f:
-            f.write(state_str)
+    state_bytes = orjson.dumps(state)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Updated save state: {state_bytes.decode('utf-8')}")
+    write_state(state_bytes)
     logger.info("Wrote updated save state")
 
-def fetch_rss_feed(url: str) -> atoma.rss.RSSChannel|None:
+def iter_feed_items(content: bytes) -> Iterator[SimpleNamespace]:
+    # Pull out only the item fields we use, discarding each element once read
+    for _, elem in etree.iterparse(BytesIO(content), tag='item', resolve_entities=False):
+        yield SimpleNamespace(
+            guid=elem.findtext('guid', '').strip(),
+            title=elem.findtext('title', '').strip(),
+            description=elem.findtext('description', '').strip())
+        elem.clear()
+
+def fetch_rss_feed(url: str, state: dict[str, Any]) -> tuple[list[SimpleNamespace]|object|None, dict[str, str|None]]:
+    # Send cache validators from the last fetch so an unchanged feed isn't re-sent
+    headers = {
+        'Accept-Encoding': 'gzip, deflate, br',
+        'User-Agent': USER_AGENT,
+    }
+    if state.get('etag'):
+        headers['If-None-Match'] = state['etag']
+    if state.get('last_modified'):
+        headers['If-Modified-Since'] = state['last_modified']
+
     try:
-        res = requests.get(url, timeout=REQUEST_TIMEOUT)
+        res = session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+        if res.status_code == 304:
+            logger.info("RSS feed has not been modified")
+            return FEED_NOT_MODIFIED, {}
         res.raise_for_status()
-        feed = atoma.parse_rss_bytes(res.content)
+        items = list(iter_feed_items(res.content))
         logger.info("RSS feed fetched and parsed successfully")
-        return feed
+        cache_headers = {
+            'etag': res.headers.get('ETag'),
+            'last_modified': res.headers.get('Last-Modified'),
+        }
+        return items, cache_headers
     except requests.RequestException as ex:
         logger.exception("Failed to fetch RSS feed")
-        return None
-
-def process_feed_items(items: list[Any], articles_seen: list[str]) -> list[tuple[str, str]]:
-    articles_to_publish: list[tuple[str, str]] = []
-    for item in items:
-        guid = bleach.clean(item.guid)
-        if guid in articles_seen:
-            logger.debug(f"Article {guid} has been seen already, skipping")
+        return None, {}
+    except etree.XMLSyntaxError as ex:
+        logger.exception("Failed to parse RSS feed")
+        return None, {}
+
+# Items are expected newest first, as in the feed, and are returned oldest to newest
+def process_feed_items(items: list[Any], articles_seen: collections.deque[str]) -> list[tuple[str, list[dict[str, str]]]]:
+    articles_to_publish: list[tuple[str, list[dict[str, str]]]] = []
+    # Set for constant time lookups, the deque keeps publish order for eviction
+    seen = set(articles_seen)
+    # Process in chronological order without modifying the feed
+    for item in reversed(items):
+        # Check the raw guid first, already seen articles need no further work
+        guid = item.guid
+        if guid in seen:
+            logger.debug("Article %s has been seen already, skipping", guid)
+            continue
+
+        # GUIDs are plain identifiers, reject anything else rather than sanitizing
+        if not guid_pat.fullmatch(guid):
+            logger.warning(f"Article has an invalid guid, skipping. '{guid}'")
             continue
 
         # Sanitize article data
-        title = bleach.clean(item.title)
-        desc = re.sub(br_pat, '\n', item.description).rstrip()
-        desc = bleach.clean(desc)
+        title = clean_text(item.title)
+        desc = item.description.replace('<br />', '\n').replace('<br/>', '\n').replace('<br>', '\n').rstrip()
+        desc = clean_text(desc)
 
         # Ignore things we're not interested in
         if filter_item(title, desc):
@@ -199,44 +326,72 @@ def process_feed_items(items: list[Any], articles_seen: list[str]) -> list[tuple
         logger.info(f"{guid} {EMDASH} {title}")
 
         # Build and publish article
-        content = f"**{title}** {EMDASH} [Link]({GALNET_BASE_URL}/{guid})\n```\n{desc}```"
-        articles_to_publish.append((guid, content))
+        logger.debug("Article Length - %d", len(desc))
+        articles_to_publish.append((guid, build_embeds(guid, title, desc)))
     return articles_to_publish
 
-def publish_articles(webhook_url: str, articles_to_publish: list[tuple[str, str]], articles_seen: list[str]) -> int:
+def rate_limit_delay(res: requests.Response) -> float:
+    # Only throttle when the webhook reports the bucket is exhausted
+    if res.status_code == 429:
+        delay = res.headers.get('Retry-After')
+    elif res.headers.get('X-RateLimit-Remaining') == '0':
+        delay = res.headers.get('X-RateLimit-Reset-After')
+    else:
+        return 0.0
+
+    try:
+        return float(delay) if delay else DEFAULT_RATE_LIMIT_DELAY
+    except ValueError:
+        return DEFAULT_RATE_LIMIT_DELAY
+
+def wait_for_rate_limit(delay_secs: float):
+    logger.debug("Rate limited, sleeping for %s seconds", delay_secs)
+    time.sleep(delay_secs)
+
+def post_message(webhook_url: str, content: dict[str, Any]) -> requests.Response:
+    # Retry a 429 a limited number of times so a long rate limit can't run out the
+    # Lambda timeout, once exhausted the error is raised and progress is saved
+    for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+        res = session.post(webhook_url, json=content, timeout=REQUEST_TIMEOUT)
+        if res.status_code != 429:
+            break
+        delay_secs = rate_limit_delay(res)
+        if attempt == MAX_RATE_LIMIT_RETRIES or delay_secs > MAX_RATE_LIMIT_DELAY:
+            logger.warning(f"Webhook rate limited, giving up after {attempt + 1} attempt(s)")
+            break
+        wait_for_rate_limit(delay_secs)
+    res.raise_for_status()
+    return res
+
+def publish_articles(webhook_url: str, articles_to_publish: list[tuple[str, list[dict[str, str]]]], articles_seen: collections.deque[str]) -> int:
     logger.info("Publishing new articles...")
     published_count: int = 0
-    for (guid, content) in articles_to_publish:
-        logger.debug(f"Article Length - {len(content)}")
-        parts = paginate_message(content)
-        for part in parts:
-            content = { 'content': part }
-            try:
-                res = requests.post(webhook_url, json=content, timeout=REQUEST_TIMEOUT)
-                res.raise_for_status()
-            except:
-                logger.exception("Error while posting article to webhook")
-                return published_count
-            time.sleep(1)
-        else:
+    delay_secs = 0.0
+    # Messages are posted serially so they appear in order in the channel
+    for (embeds, guids) in batch_embeds(articles_to_publish):
+        # Wait out an exhausted rate limit only when there is another post to make
+        if delay_secs:
+            wait_for_rate_limit(min(delay_secs, MAX_RATE_LIMIT_DELAY))
+
+        try:
+            res = post_message(webhook_url, { 'embeds': embeds })
+        except:
+            logger.exception("Error while posting articles to webhook")
+            return published_count
+        delay_secs = rate_limit_delay(res)
+
+        for guid in guids:
             articles_seen.append(guid)
             published_count += 1
             logger.info(f"Successfully published {guid}")
-        time.sleep(1)
     return published_count
 
-def prune_articles_seen(articles_seen: list[str], state: dict[str, Any]):
-    num_articles_seen = len(articles_seen)
-    if num_articles_seen > MAX_ARTICLES_SEEN:
-        num_to_prune = num_articles_seen - MAX_ARTICLES_SEEN
-        state['articles_seen'] = articles_seen[num_to_prune:]
-        logger.debug(f"Pruned {num_to_prune} articles")
-
 def lambda_handler(event: dict[str, Any]|None, context:Any|None):
     # Set logging level from the environment
     set_logger_level(os.environ.get('LOGGING_LEVEL'))
 
-    logger.debug(f"event = {json.dumps(event)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"event = {json.dumps(event)}")
 
     # Validate environment variables
     if not rss_url:
@@ -250,21 +405,28 @@ def lambda_handler(event: dict[str, Any]|None, context:Any|None):
 
     # Load previous state
     state = load_state()
+    loaded_digest = state_digest(state)
 
-    # Get list of articles already seen
-    articles_seen: list[str] = state.setdefault('articles_seen', [])
+    # Get articles already seen, the oldest are evicted once the limit is reached
+    articles_seen: collections.deque[str] = collections.deque(state.get('articles_seen', []), maxlen=MAX_ARTICLES_SEEN)
 
     # Get / parse RSS feed
-    feed = fetch_rss_feed(rss_url)
-    if not feed:
+    items, cache_headers = fetch_rss_feed(rss_url, state)
+    if items is FEED_NOT_MODIFIED:
+        logger.info("No new articles found to publish")
+        return
+    if items is None:
         return {"statusCode": 500, "body": "Failed to fetch RSS feed"}
 
-    # Process in chronological order
-    items = feed.items
-    items.reverse()   # Oldest to newest
+    # Feed version and newest article, remembered once everything in the feed is handled
+    feed_state = {**cache_headers, 'last_seen_guid': items[0].guid if items else None}
 
-    # Find articles to publish
-    articles_to_publish = process_feed_items(items, articles_seen)
+    # Find articles to publish, unless the newest article is the one we last saw
+    if items and state.get('last_seen_guid') == items[0].guid:
+        logger.debug("Newest article is unchanged since the last run")
+        articles_to_publish = []
+    else:
+        articles_to_publish = process_feed_items(items, articles_seen)
     if articles_to_publish:
         # Fetch webhook url
         webhook_url = get_webhook_url()
@@ -272,16 +434,27 @@ def lambda_handler(event: dict[str, Any]|None, context:Any|None):
         # Publish articles
         published_count = publish_articles(webhook_url, articles_to_publish, articles_seen)
 
-        # Prune seen articles
-        prune_articles_seen(articles_seen, state)
+        # Update seen articles
+        state['articles_seen'] = list(articles_seen)
 
-        # Save updated state
-        save_state(state)
+        # Only remember the feed version once all of its articles are published,
+        # otherwise the failed ones would be skipped on the next run
+        if published_count == len(articles_to_publish):
+            state.update(feed_state)
 
         logger.info(f"Published {published_count} new article(s).")
     else:
         logger.info("No new articles found to publish")
 
+        # Remember the feed version so the next run can skip it
+        state.update(feed_state)
+
+    # Save updated state, skipping the write if nothing changed
+    if state_digest(state) != loaded_digest:
+        save_state(state)
+    else:
+        logger.info("State unchanged, skipping write")
+
 if __name__ == '__main__':
     logging.basicConfig(stream=sys.stdout)
     lambda_handler(None, None)